@@ -16,11 +16,21 @@ from __future__ import annotations
 
 import argparse
 import csv
+import functools
+import hashlib
+import itertools
 import json
+import os
 import random
 import re
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Dict, Iterable, List, Sequence
+from typing import Any, Dict, Iterable, Iterator, List, Sequence
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 
 NOISE_TOKENS = {
@@ -49,106 +59,179 @@ NOISE_TOKENS = {
     "2",
 }
 
+# Common container/source tokens and fps/take markers that may be inserted by
+# downloaded filenames but absent in descriptions.csv.
+SOURCE_TOKEN_RE = re.compile(
+    r"(?:^|[_-])(?:full[-_]?videos|split[-_]?videos|video[-_]?masks|switch[-_]?frames)(?:[_-]|$)"
+)
+FPS_TOKEN_RE = re.compile(r"(?:^|[_-])(?:8|16|24|30)fps(?:[_-]|$)")
+TAKE_TOKEN_RE = re.compile(r"(?:^|[_-])take[-_]?[12](?:[_-]|$)")
+# Maps every byte outside [a-z0-9] to a space, so bytes.split() tokenizes the same
+# way as re.split(r"[^a-z0-9]+") without a regex pass per name.
+NON_ALNUM_TABLE = bytes(c if (48 <= c <= 57 or 97 <= c <= 122) else 32 for c in range(256))
+NOISE_TOKENS_BYTES = frozenset(t.encode("ascii") for t in NOISE_TOKENS)
+SAFE_ID_RE = re.compile(r"[^A-Za-z0-9._-]+")
+
+
+def _id_fingerprint(sample_id: str) -> int:
+    """64-bit stable digest of a sample id, used for duplicate detection."""
+    return int.from_bytes(hashlib.blake2b(sample_id.encode("utf-8"), digest_size=8).digest(), "big")
+
 
 def _safe_id(value: str, idx: int) -> str:
-    value = value.strip()
-    if not value:
-        value = f"physics_{idx:06d}"
-    value = re.sub(r"[^A-Za-z0-9._-]+", "_", value)
+    value = SAFE_ID_RE.sub("_", value.strip())
     return value or f"physics_{idx:06d}"
 
 
-def _parse_csv(path: Path) -> List[dict]:
+def _iter_csv_projected(
+    path: Path,
+    prompt_column: str,
+    id_column: str,
+    filename_columns: Sequence[str],
+) -> Iterator[tuple[str, str, list[str]]]:
+    """Yield (prompt, raw_id, candidate names) per CSV row.
+
+    Uses csv.reader with column positions resolved once from the header, so no
+    per-row dict is built for columns that are never read.
+    """
     with path.open("r", encoding="utf-8", newline="") as f:
-        reader = csv.DictReader(f)
-        return list(reader)
+        reader = csv.reader(f)
+        header = next(reader, None)
+        if header is None:
+            return
+        # Later duplicate headers win, matching csv.DictReader.
+        positions = {name: i for i, name in enumerate(header)}
+        prompt_pos = positions.get(prompt_column, -1)
+        id_pos = positions.get(id_column, -1)
+        name_positions = [positions[col] for col in filename_columns if col in positions]
+
+        for row in reader:
+            if not row:
+                continue
+            width = len(row)
+            prompt = row[prompt_pos].strip() if 0 <= prompt_pos < width else ""
+            raw_id = row[id_pos].strip() if 0 <= id_pos < width else ""
+            names = [v for v in (row[i].strip() for i in name_positions if i < width) if v]
+            yield prompt, raw_id, names
+
+
+def _jsonl_line(row: Dict[str, Any]) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(row) + b"\n"
+    return (json.dumps(row, ensure_ascii=False) + "\n").encode("utf-8")
 
 
 def _split_csv_arg(raw: str) -> list[str]:
     return [x.strip() for x in raw.split(",") if x.strip()]
 
 
+@functools.lru_cache(maxsize=65536)
 def _normalize_name(name: str) -> str:
     stem = Path(name).stem.lower()
-    # Remove common container/source tokens and fps/take markers that may be inserted
-    # by downloaded filenames but absent in descriptions.csv.
-    stem = re.sub(r"(?:^|[_-])(?:full[-_]?videos|split[-_]?videos|video[-_]?masks|switch[-_]?frames)(?:[_-]|$)", "_", stem)
-    stem = re.sub(r"(?:^|[_-])(?:8|16|24|30)fps(?:[_-]|$)", "_", stem)
-    stem = re.sub(r"(?:^|[_-])take[-_]?[12](?:[_-]|$)", "_", stem)
-    parts = re.split(r"[^a-z0-9]+", stem)
-    filtered = [p for p in parts if p and p not in NOISE_TOKENS]
-    return "".join(filtered)
+    stem = SOURCE_TOKEN_RE.sub("_", stem)
+    stem = FPS_TOKEN_RE.sub("_", stem)
+    stem = TAKE_TOKEN_RE.sub("_", stem)
+    # Non-ASCII characters become "?" and are treated as separators, as before.
+    parts = stem.encode("ascii", "replace").translate(NON_ALNUM_TABLE).split()
+    return b"".join(p for p in parts if p not in NOISE_TOKENS_BYTES).decode("ascii")
+
+
+def _iter_mp4_files(root: Path) -> Iterator[str]:
+    """Yield paths of *.mp4 regular files (or links to them) under root without building a Path per entry."""
+    stack = [str(root)]
+    while stack:
+        directory = stack.pop()
+        try:
+            with os.scandir(directory) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    elif entry.name.endswith(".mp4") and entry.is_file():
+                        yield entry.path
+        except PermissionError:
+            continue
+
+
+def _index_root(root: Path) -> tuple[Dict[str, List[Path]], Dict[str, List[Path]]]:
+    by_basename: Dict[str, List[Path]] = {}
+    by_normalized: Dict[str, List[Path]] = {}
+    # Paths are stored as found; only the winning match is resolved (see _pick_best_match).
+    for p in _iter_mp4_files(root):
+        name = os.path.basename(p)
+        path = Path(p)
+        by_basename.setdefault(name, []).append(path)
+        by_normalized.setdefault(_normalize_name(name), []).append(path)
+    return by_basename, by_normalized
 
 
 def _build_indexes(search_roots: Iterable[Path]) -> tuple[Dict[str, List[Path]], Dict[str, List[Path]]]:
     by_basename: Dict[str, List[Path]] = {}
     by_normalized: Dict[str, List[Path]] = {}
-    for root in search_roots:
-        if not root.exists():
-            continue
-        for p in root.rglob("*.mp4"):
-            rp = p.resolve()
-            by_basename.setdefault(rp.name, []).append(rp)
-            norm = _normalize_name(rp.name)
-            by_normalized.setdefault(norm, []).append(rp)
+    roots = [root for root in search_roots if root.exists()]
+    if not roots:
+        return by_basename, by_normalized
+
+    # Roots often live on separate mounts; walking them concurrently overlaps the I/O.
+    with ThreadPoolExecutor(max_workers=min(8, len(roots))) as executor:
+        results = list(executor.map(_index_root, roots))
+    for root_basename, root_normalized in results:
+        for key, paths in root_basename.items():
+            by_basename.setdefault(key, []).extend(paths)
+        for key, paths in root_normalized.items():
+            by_normalized.setdefault(key, []).extend(paths)
     return by_basename, by_normalized
 
 
-def _rank_match(path: Path, prefer_substrings: Sequence[str], take_filter: str) -> tuple[int, int, int, str]:
-    s = str(path).lower()
+@functools.lru_cache(maxsize=None)
+def _rank_match(path: str, prefer_substrings: tuple[str, ...], take_filter: str) -> tuple[int, int, int, str]:
+    # prefer_substrings and take_filter are expected to be lowercased by the caller.
+    # They are fixed for a run, so results are cached per path across rows.
+    s = path.lower()
     take_rank = 1
-    if take_filter and take_filter.lower() in s:
+    if take_filter and take_filter in s:
         take_rank = 0
     pref_rank = len(prefer_substrings)
     for i, sub in enumerate(prefer_substrings):
-        if sub and sub.lower() in s:
+        if sub and sub in s:
             pref_rank = i
             break
-    depth_rank = len(path.parts)
+    depth_rank = len(Path(path).parts)
     len_rank = len(s)
     return (take_rank, pref_rank, depth_rank, len_rank)
 
 
-def _pick_best_match(matches: List[Path], prefer_substrings: Sequence[str], take_filter: str) -> Path | None:
+def _pick_best_match(matches: List[Path], prefer_substrings: tuple[str, ...], take_filter: str) -> Path | None:
     if not matches:
         return None
-    ranked = sorted(matches, key=lambda p: _rank_match(p, prefer_substrings, take_filter))
-    return ranked[0]
+    best = min(matches, key=lambda p: _rank_match(str(p), prefer_substrings, take_filter))
+    return best.resolve()
 
 
 def _resolve_video_path(
-    row: dict,
-    filename_columns: list[str],
+    candidates: Sequence[str],
     by_basename: Dict[str, List[Path]],
     by_normalized: Dict[str, List[Path]],
-    prefer_substrings: Sequence[str],
+    prefer_substrings: tuple[str, ...],
     take_filter: str,
 ) -> Path | None:
-    candidates: list[str] = []
-    for col in filename_columns:
-        raw = row.get(col)
-        if raw:
-            raw_s = str(raw).strip()
-            if raw_s:
-                candidates.append(raw_s)
-
+    # Probe every exact basename before any normalized one; scenario and
+    # generated_video_name frequently share a stem, so dedupe the probes first.
+    probes: list[str] = []
     for cand in candidates:
-        names_to_try = [Path(cand).name]
-        if not Path(cand).suffix:
-            names_to_try.append(f"{cand}.mp4")
-
-        for name in names_to_try:
-            matches = by_basename.get(name, [])
-            best = _pick_best_match(matches, prefer_substrings, take_filter)
-            if best is not None:
-                return best
-
-        for name in names_to_try:
-            norm = _normalize_name(name)
-            nmatches = by_normalized.get(norm, [])
-            best = _pick_best_match(nmatches, prefer_substrings, take_filter)
-            if best is not None:
-                return best
+        probes.append(os.path.basename(cand))
+        if not os.path.splitext(cand)[1]:
+            probes.append(f"{cand}.mp4")
+    probes = list(dict.fromkeys(probes))
+
+    for name in probes:
+        best = _pick_best_match(by_basename.get(name, []), prefer_substrings, take_filter)
+        if best is not None:
+            return best
+
+    for norm in dict.fromkeys(_normalize_name(name) for name in probes):
+        best = _pick_best_match(by_normalized.get(norm, []), prefer_substrings, take_filter)
+        if best is not None:
+            return best
 
     return None
 
@@ -203,84 +286,84 @@ def main() -> int:
     args = parse_args()
 
     csv_path = Path(args.descriptions_csv).expanduser().resolve()
-    rows = _parse_csv(csv_path)
-    if not rows:
+    filename_columns = _split_csv_arg(args.filename_columns)
+    rows = _iter_csv_projected(csv_path, args.prompt_column, args.id_column, filename_columns)
+    first_row = next(rows, None)
+    if first_row is None:
         raise ValueError(f"No rows found in {csv_path}")
 
-    filename_columns = _split_csv_arg(args.filename_columns)
     search_roots = [Path(x).expanduser().resolve() for x in _split_csv_arg(args.video_search_roots)]
-    prefer_substrings = _split_csv_arg(args.prefer_path_substrings)
+    prefer_substrings = tuple(s.lower() for s in _split_csv_arg(args.prefer_path_substrings))
     by_basename, by_normalized = _build_indexes(search_roots)
 
-    indices = list(range(len(rows)))
+    # Rows are streamed and projected down to the handful of columns we use, so a
+    # small --limit stops reading early. Only --shuffle needs the whole CSV, and
+    # then only the projected tuples are kept.
+    projected: Iterable[tuple[int, tuple[str, str, list[str]]]] = enumerate(
+        itertools.chain((first_row,), rows)
+    )
     if args.shuffle:
+        projected = list(projected)
         rng = random.Random(args.seed)
-        rng.shuffle(indices)
+        rng.shuffle(projected)
 
     out_path = Path(args.output_manifest).expanduser().resolve()
     out_path.parent.mkdir(parents=True, exist_ok=True)
 
+    take_filter = args.take_filter.lower()
     wrote = 0
     skipped = 0
-    seen: set[str] = set()
+    # Fingerprints rather than full ids keep the dedup set small on large datasets;
+    # a digest collision only appends the index suffix to an otherwise unique id.
+    seen: set[int] = set()
     debug_miss_count = 0
     considered_after_filter = 0
 
-    with out_path.open("w", encoding="utf-8") as f:
-        for out_idx, idx in enumerate(indices, 1):
-            row = rows[idx]
-
-            prompt = str(row.get(args.prompt_column, "")).strip()
+    with out_path.open("wb", buffering=1 << 20) as f:
+        for out_idx, (idx, (prompt, raw_id, names)) in enumerate(projected, 1):
             if not prompt:
                 skipped += 1
                 continue
 
-            if args.take_filter:
-                probe = " ".join(str(row.get(c, "")) for c in filename_columns).lower()
-                if args.take_filter.lower() not in probe:
-                    skipped += 1
-                    continue
+            if take_filter and take_filter not in " ".join(names).lower():
+                skipped += 1
+                continue
             considered_after_filter += 1
             if args.limit > 0 and considered_after_filter > args.limit:
                 break
 
             video_path = _resolve_video_path(
-                row,
-                filename_columns,
+                names,
                 by_basename,
                 by_normalized,
                 prefer_substrings,
-                args.take_filter,
+                take_filter,
             )
-            if video_path is None or not video_path.is_file():
+            # Matches come from the index walk, which only keeps regular files.
+            if video_path is None:
                 if args.debug_misses > 0 and debug_miss_count < args.debug_misses:
                     debug_miss_count += 1
-                    raw_names = [str(row.get(c, "")).strip() for c in filename_columns if row.get(c)]
-                    print(f"[debug miss {debug_miss_count}] row_index={idx} names={raw_names}")
+                    print(f"[debug miss {debug_miss_count}] row_index={idx} names={names}")
                 skipped += 1
                 continue
 
-            raw_id = str(row.get(args.id_column, "")).strip()
-            if not raw_id:
-                for c in filename_columns:
-                    if row.get(c):
-                        raw_id = str(row[c]).strip()
-                        break
-            sample_id = _safe_id(Path(raw_id).stem if raw_id else "", out_idx)
-            if sample_id in seen:
+            if not raw_id and names:
+                raw_id = names[0]
+            sample_id = _safe_id(os.path.splitext(os.path.basename(raw_id))[0] if raw_id else "", out_idx)
+            fingerprint = _id_fingerprint(sample_id)
+            if fingerprint in seen:
                 sample_id = f"{sample_id}_{out_idx:06d}"
-            seen.add(sample_id)
+                fingerprint = _id_fingerprint(sample_id)
+            seen.add(fingerprint)
 
             f.write(
-                json.dumps(
+                _jsonl_line(
                     {
                         "sample_id": sample_id,
                         "prompt": prompt,
                         "ground_truth_video": str(video_path),
-                    },
-                    ensure_ascii=False,
+                    }
                 )
-                + "\n"
             )
             wrote += 1
 
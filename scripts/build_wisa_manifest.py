@@ -15,14 +15,24 @@ Supports either:
 from __future__ import annotations
 
 import argparse
+import hashlib
 import json
+import os
 import random
 import re
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+from multiprocessing import Pool
 from pathlib import Path
-from typing import Any, Dict, Iterable, Optional
+from typing import Any, Dict, Iterable, Iterator, Optional, Tuple
 
 from datasets import Dataset, concatenate_datasets, load_dataset, load_from_disk
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 
 DEFAULT_PROMPT_KEYS = (
     "prompt",
@@ -46,65 +56,110 @@ DEFAULT_VIDEO_KEYS = (
     "video_file",
 )
 DEFAULT_ID_KEYS = ("sample_id", "id", "uid", "name", "video_id", "sha256", "video_name")
+SAFE_ID_RE = re.compile(r"[^A-Za-z0-9._-]+")
+RESOLVE_CHUNKSIZE = 256
+SAMPLE_BATCH_SIZE = 256
+WRITE_CHUNK_BYTES = 1 << 20
+
+# Per-process resolution context, populated by _init_resolver (once per pool worker).
+_RESOLVER: Dict[str, Any] = {}
 
 
 def _parse_list(raw: str) -> list[str]:
     return [x.strip() for x in raw.split(",") if x.strip()]
 
 
-def _pick(record: Dict[str, Any], keys: Iterable[str]) -> Optional[Any]:
+def _has_value(val: Any) -> bool:
+    return val is not None and not (isinstance(val, str) and not val.strip())
+
+
+def _pick_key(record: Dict[str, Any], keys: Iterable[str]) -> Optional[str]:
     for k in keys:
-        if k in record and record[k] is not None:
-            val = record[k]
-            if isinstance(val, str) and not val.strip():
-                continue
-            return val
+        if _has_value(record.get(k)):
+            return k
     return None
 
 
+def _leading_key(keys: Iterable[str], columns: Iterable[str]) -> Optional[str]:
+    columns = set(columns)
+    return next((k for k in keys if k in columns), None)
+
+
+def _pick(record: Dict[str, Any], keys: Iterable[str], lead: Optional[str] = None) -> Optional[Any]:
+    """Return the value of the first usable key.
+
+    ``lead`` is the highest-priority key the row can hold (rows sharing a fixed
+    column set); when it has a value no earlier key can, so the scan is skipped.
+    """
+    if lead is not None:
+        value = record.get(lead)
+        if _has_value(value):
+            return value
+    key = _pick_key(record, keys)
+    return record[key] if key is not None else None
+
+
+def _jsonl_line(row: Dict[str, Any]) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(row) + b"\n"
+    return (json.dumps(row, ensure_ascii=False) + "\n").encode("utf-8")
+
+
+def _id_fingerprint(sample_id: str) -> int:
+    return int.from_bytes(hashlib.blake2b(sample_id.encode("utf-8"), digest_size=8).digest(), "big")
+
+
 def _safe_id(value: str, index: int) -> str:
-    value = value.strip()
-    if not value:
-        value = f"wisa_{index:06d}"
-    value = re.sub(r"[^A-Za-z0-9._-]+", "_", value)
+    value = SAFE_ID_RE.sub("_", value.strip())
     return value or f"wisa_{index:06d}"
 
 
+def _write_video_bytes(out_path: Path, data: bytes) -> None:
+    fd = os.open(out_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        view = memoryview(data)
+        offset = 0
+        while offset < len(view):
+            offset += os.write(fd, view[offset : offset + WRITE_CHUNK_BYTES])
+        # These files are not read back here; keep them from crowding the page cache.
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
+
+
 def _resolve_video_path(
-    sample: Dict[str, Any],
-    video_keys: list[str],
+    raw_video: Any,
     sample_id: str,
     materialize_dir: Optional[Path],
     video_root: Optional[Path],
     basename_index: Optional[Dict[str, Path]],
-) -> Optional[Path]:
-    def _resolve_string_path(raw_path: str) -> Optional[Path]:
-        candidate = Path(raw_path)
-        if candidate.exists():
-            return candidate.resolve()
+    indexed_paths: Optional[set[str]],
+) -> Tuple[Optional[Path], bool]:
+    """Return (path, was_indexed); indexed paths are known regular files and need no re-stat."""
 
+    def _resolve_string_path(raw_path: str) -> Tuple[Optional[Path], bool]:
+        candidates = [Path(raw_path)]
         if video_root is not None:
-            rooted = (video_root / raw_path).expanduser()
-            if rooted.exists():
-                return rooted.resolve()
+            candidates.append((video_root / raw_path).expanduser())
+            if not os.path.splitext(raw_path)[1]:
+                candidates.append((video_root / f"{raw_path}.mp4").expanduser())
 
-            if not Path(raw_path).suffix:
-                rooted_mp4 = (video_root / f"{raw_path}.mp4").expanduser()
-                if rooted_mp4.exists():
-                    return rooted_mp4.resolve()
+        for candidate in candidates:
+            # Files seen while indexing the search roots need no extra stat.
+            if indexed_paths is not None and os.path.abspath(candidate) in indexed_paths:
+                return candidate.resolve(), True
+            if candidate.exists():
+                return candidate.resolve(), False
 
         if basename_index is not None:
-            base = Path(raw_path).name
+            base = os.path.basename(raw_path)
             if base in basename_index:
-                return basename_index[base]
-            if not Path(base).suffix and f"{base}.mp4" in basename_index:
-                return basename_index[f"{base}.mp4"]
+                return basename_index[base], True
+            if not os.path.splitext(base)[1] and f"{base}.mp4" in basename_index:
+                return basename_index[f"{base}.mp4"], True
 
-        return None
-
-    raw_video = _pick(sample, video_keys)
-    if raw_video is None:
-        return None
+        return None, False
 
     # Common cases in HF datasets:
     # - string path
@@ -115,9 +170,9 @@ def _resolve_video_path(
     if isinstance(raw_video, dict):
         path_val = raw_video.get("path")
         if isinstance(path_val, str) and path_val:
-            path = _resolve_string_path(path_val)
+            path, was_indexed = _resolve_string_path(path_val)
             if path is not None:
-                return path
+                return path, was_indexed
 
         bytes_val = raw_video.get("bytes")
         if bytes_val is not None:
@@ -127,10 +182,54 @@ def _resolve_video_path(
                 )
             materialize_dir.mkdir(parents=True, exist_ok=True)
             out_path = materialize_dir / f"{sample_id}.mp4"
-            out_path.write_bytes(bytes_val)
-            return out_path
+            _write_video_bytes(out_path, bytes_val)
+            return out_path, False
 
-    return None
+    return None, False
+
+
+def _init_resolver(
+    materialize_dir: Optional[Path],
+    video_root: Optional[Path],
+    basename_index: Optional[Dict[str, Path]],
+    indexed_paths: Optional[set[str]],
+) -> None:
+    _RESOLVER["materialize_dir"] = materialize_dir
+    _RESOLVER["video_root"] = video_root
+    _RESOLVER["basename_index"] = basename_index
+    _RESOLVER["indexed_paths"] = indexed_paths
+
+
+def _resolve_task(task: Tuple[str, Any]) -> Optional[str]:
+    """Resolve one (sample_id, raw_video) pair to an absolute video path string."""
+    sample_id, raw_video = task
+    video_path, was_indexed = _resolve_video_path(
+        raw_video,
+        sample_id,
+        _RESOLVER["materialize_dir"],
+        _RESOLVER["video_root"],
+        _RESOLVER["basename_index"],
+        _RESOLVER["indexed_paths"],
+    )
+    if video_path is None:
+        return None
+    # Ad-hoc paths (cwd/--video-root probes, materialized bytes) may not be regular files.
+    if not was_indexed and not video_path.is_file():
+        return None
+    return str(video_path.resolve())
+
+
+def _resolve_row(task: Tuple[str, str, Any, bool]) -> Tuple[str, str, Optional[str]]:
+    """Resolve one (sample_id, prompt, raw_video, already_resolved) task."""
+    sample_id, prompt, video, resolved = task
+    return sample_id, prompt, video if resolved else _resolve_task((sample_id, video))
+
+
+def _available_cpus() -> int:
+    # sched_getaffinity honours Slurm's --cpus-per-task; cpu_count() sees the whole node.
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0)) or 1
+    return os.cpu_count() or 1
 
 
 def parse_args() -> argparse.Namespace:
@@ -203,6 +302,12 @@ def parse_args() -> argparse.Namespace:
         action="store_true",
         help="Shuffle before applying --limit.",
     )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=_available_cpus(),
+        help="Processes used to resolve video paths (1 resolves in-process). Default: CPUs this job may use.",
+    )
     parser.add_argument(
         "--materialize-video-dir",
         default=None,
@@ -260,16 +365,74 @@ def _load_json_rows(json_path: Path, records_key: str) -> list[dict]:
     return out
 
 
-def _build_basename_index(search_roots: list[Path]) -> Dict[str, Path]:
-    index: Dict[str, Path] = {}
-    for root in search_roots:
-        if not root.exists():
+def _iter_mp4_files(root: Path) -> Iterator[str]:
+    stack = [str(root)]
+    while stack:
+        directory = stack.pop()
+        try:
+            with os.scandir(directory) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    elif entry.name.endswith(".mp4") and entry.is_file():
+                        yield entry.path
+        except PermissionError:
             continue
-        for p in root.rglob("*.mp4"):
-            name = p.name
-            if name not in index:
-                index[name] = p.resolve()
-    return index
+
+
+def _index_root(root: Path) -> Tuple[Dict[str, Path], set[str]]:
+    index: Dict[str, Path] = {}
+    paths: set[str] = set()
+    for p in _iter_mp4_files(root):
+        paths.add(p)
+        name = os.path.basename(p)
+        if name not in index:
+            # Resolved lazily by the resolver for the rows that actually use it.
+            index[name] = Path(p)
+    return index, paths
+
+
+def _iter_samples(
+    ds: Dataset | list[dict],
+    indices: list[int],
+    keys: Iterable[str],
+) -> Iterator[Dict[str, Any]]:
+    """Yield the rows at indices; for HF datasets, only the candidate key columns are read."""
+    if not isinstance(ds, Dataset):
+        for idx in indices:
+            yield ds[idx]
+        return
+
+    # Decode only the candidate columns, a bounded batch at a time, instead of a
+    # full row dict per ds[idx]; a bytes-bearing video column never sits in RAM whole.
+    present = [k for k in dict.fromkeys(keys) if k in ds.column_names]
+    if not present:
+        for _ in indices:
+            yield {}
+        return
+    subset = ds.select(indices).select_columns(present)
+    for batch in subset.iter(batch_size=SAMPLE_BATCH_SIZE):
+        columns = [batch[k] for k in present]
+        for values in zip(*columns):
+            yield dict(zip(present, values))
+
+
+def _build_basename_index(search_roots: list[Path]) -> Tuple[Dict[str, Path], set[str]]:
+    """Index *.mp4 under search_roots by basename, plus the set of every indexed path."""
+    index: Dict[str, Path] = {}
+    indexed_paths: set[str] = set()
+    roots = [root for root in search_roots if root.exists()]
+    if not roots:
+        return index, indexed_paths
+
+    with ThreadPoolExecutor(max_workers=min(8, len(roots))) as executor:
+        results = list(executor.map(_index_root, roots))
+    # Merge in root order so earlier roots keep winning basename collisions.
+    for root_index, root_paths in results:
+        for name, path in root_index.items():
+            index.setdefault(name, path)
+        indexed_paths.update(root_paths)
+    return index, indexed_paths
 
 
 def main() -> int:
@@ -291,7 +454,10 @@ def main() -> int:
             for x in args.video_search_roots.split(",")
             if x.strip()
         ]
-    basename_index = _build_basename_index(search_roots) if search_roots else None
+    basename_index: Optional[Dict[str, Path]] = None
+    indexed_paths: Optional[set[str]] = None
+    if search_roots:
+        basename_index, indexed_paths = _build_basename_index(search_roots)
 
     mode_count = int(bool(args.dataset_path)) + int(bool(args.arrow_dir)) + int(bool(args.json_path))
     if mode_count > 1:
@@ -323,46 +489,78 @@ def main() -> int:
 
     wrote = 0
     skipped = 0
-    seen_ids: set[str] = set()
-    with out_path.open("w", encoding="utf-8") as f:
-        for out_idx, idx in enumerate(indices, 1):
-            sample = ds[idx]
-
-            raw_id = _pick(sample, id_keys)
+    # Counted by the task generator, which runs on the pool's feeder thread.
+    unusable = 0
+    seen_ids: set[int] = set()
+    # HF rows all carry the dataset's columns, so each key list has a fixed
+    # leading column; JSON records may differ per row and always get the scan.
+    columns = ds.column_names if isinstance(ds, Dataset) else ()
+    id_lead = _leading_key(id_keys, columns)
+    prompt_lead = _leading_key(prompt_keys, columns)
+    video_lead = _leading_key(video_keys, columns)
+    samples = _iter_samples(ds, indices, [*id_keys, *prompt_keys, *video_keys])
+
+    def _tasks() -> Iterator[Tuple[str, str, Any, bool]]:
+        # Ids, prompts, and dedup are cheap and order-dependent, so they stay in
+        # this process; the stat-heavy video resolution is what gets fanned out.
+        nonlocal unusable
+        for out_idx, sample in enumerate(samples, 1):
+            raw_id = _pick(sample, id_keys, id_lead)
             sample_id = _safe_id(str(raw_id) if raw_id is not None else "", out_idx)
-            if sample_id in seen_ids:
+            fingerprint = _id_fingerprint(sample_id)
+            if fingerprint in seen_ids:
                 sample_id = f"{sample_id}_{out_idx:06d}"
-            seen_ids.add(sample_id)
+                fingerprint = _id_fingerprint(sample_id)
+            seen_ids.add(fingerprint)
 
-            prompt_val = _pick(sample, prompt_keys)
+            prompt_val = _pick(sample, prompt_keys, prompt_lead)
             if prompt_val is None:
-                skipped += 1
+                unusable += 1
                 continue
             prompt = str(prompt_val).strip()
             if not prompt:
-                skipped += 1
+                unusable += 1
                 continue
 
-            video_path = _resolve_video_path(
-                sample,
-                video_keys,
-                sample_id,
-                materialize_dir,
-                video_root,
-                basename_index,
-            )
-            if video_path is None or not video_path.is_file():
+            raw_video = _pick(sample, video_keys, video_lead)
+            if raw_video is None:
+                unusable += 1
+                continue
+
+            if isinstance(raw_video, dict) and raw_video.get("bytes") is not None:
+                # Byte payloads are resolved (and materialized) right here rather
+                # than pickled to a worker, so at most one row's bytes is held.
+                yield sample_id, prompt, _resolve_task((sample_id, raw_video)), True
+            else:
+                yield sample_id, prompt, raw_video, False
+
+    workers = max(1, min(args.workers, (len(indices) + RESOLVE_CHUNKSIZE - 1) // RESOLVE_CHUNKSIZE))
+    resolver_args = (materialize_dir, video_root, basename_index, indexed_paths)
+    _init_resolver(*resolver_args)
+    with out_path.open("wb", buffering=1 << 20) as f, ExitStack() as stack:
+        if workers > 1:
+            # The basename index ships once per worker via the initializer, not per task.
+            pool = stack.enter_context(Pool(workers, initializer=_init_resolver, initargs=resolver_args))
+            # imap pulls tasks lazily and hands back results in order as they
+            # finish, so rows are written while later ones are still resolving.
+            resolved = pool.imap(_resolve_row, _tasks(), chunksize=RESOLVE_CHUNKSIZE)
+        else:
+            resolved = map(_resolve_row, _tasks())
+
+        for sample_id, prompt, video_path in resolved:
+            if video_path is None:
                 skipped += 1
                 continue
 
             row = {
                 "sample_id": sample_id,
                 "prompt": prompt,
-                "ground_truth_video": str(video_path.resolve()),
+                "ground_truth_video": video_path,
             }
-            f.write(json.dumps(row, ensure_ascii=False) + "\n")
+            f.write(_jsonl_line(row))
             wrote += 1
 
+    skipped += unusable
     print(f"Wrote {wrote} rows to {out_path}")
     print(f"Skipped {skipped} rows (missing prompt/video)")
     if basename_index is not None:
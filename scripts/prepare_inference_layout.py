@@ -20,16 +20,24 @@ from __future__ import annotations
 
 import argparse
 import csv
+import errno
 import json
 import os
 import re
 import shutil
 import subprocess
 import sys
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 from datetime import datetime, timezone
+from functools import partial
 from pathlib import Path
-from typing import Dict, Iterable, List, Optional
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 DEFAULT_MODELS = ("wan22", "wan21", "lvp")
 DEFAULT_TASKS = ("t2v", "i2v")
@@ -39,6 +47,17 @@ PROMPT_KEYS = ("prompt", "text_prompt", "caption")
 GT_KEYS = ("ground_truth_video", "ground_truth", "gt_video", "video_path", "video")
 IMAGE_KEYS = ("i2v_image", "image", "image_path", "first_frame", "first_frame_path")
 
+SAFE_ID_CHARS = "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789._-"
+SAFE_ID_RE = re.compile(r"[^A-Za-z0-9._-]+")
+# Deletes every allowed character; whatever survives str.translate needs the regex.
+SAFE_ID_STRIP_TABLE = str.maketrans("", "", SAFE_ID_CHARS)
+
+# Inputs per ffmpeg call when extracting first frames; ffmpeg opens every input
+# up front, so keep the batch small enough for fd limits and argv length.
+FIRST_FRAME_BATCH_SIZE = 32
+
+_MKDIR_CACHE: set[Path] = set()
+
 
 @dataclass
 class SampleRecord:
@@ -59,7 +78,7 @@ class SampleAssets:
     metadata_path: Path
 
 
-def _pick_value(record: Dict[str, str], keys: Iterable[str]) -> Optional[str]:
+def _pick_value(record: Dict[str, Any], keys: Iterable[str]) -> Optional[str]:
     for key in keys:
         value = record.get(key)
         if value is not None and str(value).strip() != "":
@@ -71,44 +90,49 @@ def _safe_sample_id(raw_value: str, row_index: int) -> str:
     value = raw_value.strip()
     if not value:
         value = f"sample_{row_index:05d}"
-    value = re.sub(r"[^A-Za-z0-9._-]+", "_", value)
+    if value.translate(SAFE_ID_STRIP_TABLE):
+        value = SAFE_ID_RE.sub("_", value)
     return value or f"sample_{row_index:05d}"
 
 
 def _resolve_path(raw_path: str, manifest_dir: Path) -> Path:
-    candidate = Path(raw_path).expanduser()
-    if not candidate.is_absolute():
-        candidate = manifest_dir / candidate
-    return candidate.resolve()
-
-
-def _read_manifest(path: Path) -> List[Dict[str, str]]:
+    # realpath() lstats every component, so plain paths are only normalized
+    # lexically; symlinked sources are followed when they are placed. A ".."
+    # may climb out of a symlinked directory, so those still resolve for real.
+    candidate = os.path.expanduser(raw_path)
+    if not os.path.isabs(candidate):
+        candidate = os.path.join(manifest_dir, candidate)
+    if ".." in candidate.split(os.sep):
+        return Path(candidate).resolve()
+    return Path(os.path.normpath(candidate))
+
+
+def _iter_manifest_rows(path: Path) -> Iterator[Dict[str, Any]]:
+    # Rows are streamed and keep their parsed values; _pick_value stringifies
+    # only the fields it selects.
     suffix = path.suffix.lower()
-    rows: List[Dict[str, str]] = []
     if suffix == ".jsonl":
-        with path.open("r", encoding="utf-8") as handle:
+        loads = orjson.loads if orjson is not None else json.loads
+        with path.open("rb") as handle:
             for i, line in enumerate(handle, 1):
                 line = line.strip()
                 if not line:
                     continue
                 try:
-                    data = json.loads(line)
-                except json.JSONDecodeError as exc:
+                    data = loads(line)
+                except ValueError as exc:
                     raise ValueError(f"{path}: invalid JSON on line {i}") from exc
                 if not isinstance(data, dict):
                     raise ValueError(f"{path}: JSONL line {i} is not an object")
-                rows.append({str(k): str(v) if v is not None else "" for k, v in data.items()})
+                yield data
     elif suffix == ".csv":
         with path.open("r", encoding="utf-8", newline="") as handle:
-            reader = csv.DictReader(handle)
-            for row in reader:
-                rows.append({str(k): str(v) if v is not None else "" for k, v in row.items()})
+            yield from csv.DictReader(handle)
     else:
         raise ValueError(f"Unsupported manifest extension: {suffix}. Use .jsonl or .csv")
-    return rows
 
 
-def _normalize_rows(rows: List[Dict[str, str]], manifest_dir: Path) -> List[SampleRecord]:
+def _normalize_rows(rows: Iterable[Dict[str, Any]], manifest_dir: Path) -> List[SampleRecord]:
     seen: Dict[str, int] = {}
     out: List[SampleRecord] = []
     for index, row in enumerate(rows, 1):
@@ -151,27 +175,95 @@ def _normalize_rows(rows: List[Dict[str, str]], manifest_dir: Path) -> List[Samp
     return out
 
 
+def _ensure_dir(directory: Path) -> None:
+    # Every sample writes several files into the same few directories; remember
+    # which ones exist so each is mkdir'd once per run.
+    if directory not in _MKDIR_CACHE:
+        directory.mkdir(parents=True, exist_ok=True)
+        _MKDIR_CACHE.add(directory)
+
+
 def _ensure_parent(path: Path) -> None:
-    path.parent.mkdir(parents=True, exist_ok=True)
+    _ensure_dir(path.parent)
 
 
-def _materialize_file(src: Path, dst: Path, mode: str) -> None:
-    _ensure_parent(dst)
-    if dst.exists() or dst.is_symlink():
-        if dst.is_dir():
-            raise IsADirectoryError(f"Refusing to overwrite directory: {dst}")
-        dst.unlink()
+# copy_file_range/sendfile errors that mean "not supported here", not a real I/O failure.
+_COPY_FALLBACK_ERRNOS = frozenset(
+    {errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.EBADF}
+)
+
+
+def _fast_copy(src: Path, dst: Path) -> None:
+    """Copy src to a new file dst in the kernel (copy_file_range, then sendfile), keeping metadata like copy2.
 
+    dst is created with O_EXCL, so an existing entry (possibly a link back to src)
+    raises FileExistsError instead of being truncated.
+    """
+    src_fd = os.open(src, os.O_RDONLY)
+    try:
+        dst_fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+        try:
+            remaining = os.fstat(src_fd).st_size
+            # copy_file_range can reflink on XFS/Btrfs; both calls advance the file
+            # offsets, so sendfile can pick up wherever it stopped.
+            copy_range = getattr(os, "copy_file_range", None)
+            while remaining > 0 and copy_range is not None:
+                try:
+                    copied = copy_range(src_fd, dst_fd, remaining)
+                except OSError as exc:
+                    if exc.errno not in _COPY_FALLBACK_ERRNOS:
+                        raise
+                    break
+                if copied == 0:
+                    break
+                remaining -= copied
+            while remaining > 0:
+                try:
+                    copied = os.sendfile(dst_fd, src_fd, None, remaining)
+                except OSError as exc:
+                    if exc.errno not in _COPY_FALLBACK_ERRNOS:
+                        raise
+                    break
+                if copied == 0:
+                    break
+                remaining -= copied
+        finally:
+            os.close(dst_fd)
+    finally:
+        os.close(src_fd)
+
+    if remaining > 0:
+        shutil.copyfile(src, dst)
+    shutil.copystat(src, dst)
+
+
+def _place_file(src: Path, dst: Path, mode: str) -> None:
     if mode == "symlink":
         dst.symlink_to(src)
     elif mode == "hardlink":
-        os.link(src, dst)
+        # link(2) does not follow symlinks (and CPython only passes AT_SYMLINK_FOLLOW
+        # for non-default arguments), so a symlinked source would be linked as the
+        # symlink itself; resolve it here, where the real inode is needed.
+        os.link(os.path.realpath(src), dst)
     elif mode == "copy":
-        shutil.copy2(src, dst)
+        _fast_copy(src, dst)
     else:
         raise ValueError(f"Unsupported materialization mode: {mode}")
 
 
+def _materialize_file(src: Path, dst: Path, mode: str) -> None:
+    _ensure_parent(dst)
+    # Fresh layouts are the common case: create first and only stat/unlink when
+    # something is already in the way.
+    try:
+        _place_file(src, dst, mode)
+    except FileExistsError:
+        if dst.is_dir():
+            raise IsADirectoryError(f"Refusing to overwrite directory: {dst}")
+        dst.unlink()
+        _place_file(src, dst, mode)
+
+
 def _extract_first_frame(video_path: Path, image_path: Path, ffmpeg_bin: str) -> None:
     _ensure_parent(image_path)
     cmd = [
@@ -194,6 +286,32 @@ def _extract_first_frame(video_path: Path, image_path: Path, ffmpeg_bin: str) ->
         ) from exc
 
 
+def _extract_first_frames_batch(pairs: List[Tuple[Path, Path]], ffmpeg_bin: str) -> None:
+    """Extract first frames for many (video, image) pairs with one ffmpeg process per batch.
+
+    Each input gets its own ``-map N:v:0 -frames:v 1 <image>`` output, so mixed
+    containers/codecs are fine. If a batch fails, its pairs are retried one by
+    one so the error names the offending video.
+    """
+    for start in range(0, len(pairs), FIRST_FRAME_BATCH_SIZE):
+        batch = pairs[start : start + FIRST_FRAME_BATCH_SIZE]
+        if len(batch) == 1:
+            _extract_first_frame(batch[0][0], batch[0][1], ffmpeg_bin)
+            continue
+
+        cmd = [ffmpeg_bin, "-hide_banner", "-loglevel", "error", "-y"]
+        for video_path, image_path in batch:
+            _ensure_parent(image_path)
+            cmd.extend(["-i", str(video_path)])
+        for input_index, (_, image_path) in enumerate(batch):
+            cmd.extend(["-map", f"{input_index}:v:0", "-frames:v", "1", str(image_path)])
+        try:
+            subprocess.run(cmd, check=True)
+        except subprocess.CalledProcessError:
+            for video_path, image_path in batch:
+                _extract_first_frame(video_path, image_path, ffmpeg_bin)
+
+
 def _write_text(path: Path, content: str) -> None:
     _ensure_parent(path)
     path.write_text(content, encoding="utf-8")
@@ -211,14 +329,23 @@ def _prepare_shared_assets(
     mode: str,
     ffmpeg_bin: str,
     extract_first_frame: bool,
+    first_frame_format: str,
     strict_i2v_inputs: bool,
+    workers: int,
+    created_utc: str,
 ) -> List[SampleAssets]:
     shared_dataset_root = run_root / "datasets" / dataset_name / "samples"
-    assets: List[SampleAssets] = []
 
-    for record in records:
+    if strict_i2v_inputs and not extract_first_frame:
+        for record in records:
+            if record.image_src is None:
+                raise ValueError(
+                    f"Sample '{record.sample_id}' has no image and first-frame extraction is disabled."
+                )
+
+    def _materialize_one(record: SampleRecord) -> Tuple[SampleAssets, Optional[Tuple[Path, Path]]]:
         sample_root = shared_dataset_root / record.sample_id
-        sample_root.mkdir(parents=True, exist_ok=True)
+        _ensure_dir(sample_root)
 
         gt_ext = record.gt_video_src.suffix or ".mp4"
         gt_dst = sample_root / f"ground_truth{gt_ext}"
@@ -228,19 +355,16 @@ def _prepare_shared_assets(
         _write_text(prompt_path, record.prompt + "\n")
 
         image_dst: Optional[Path]
+        first_frame_job: Optional[Tuple[Path, Path]] = None
         if record.image_src is not None:
             img_ext = record.image_src.suffix or ".png"
             image_dst = sample_root / f"input_image{img_ext}"
             _materialize_file(record.image_src, image_dst, mode)
         elif extract_first_frame:
-            image_dst = sample_root / "input_image.png"
-            _extract_first_frame(gt_dst, image_dst, ffmpeg_bin)
+            image_dst = sample_root / f"input_image.{first_frame_format}"
+            first_frame_job = (gt_dst, image_dst)
         else:
             image_dst = None
-            if strict_i2v_inputs:
-                raise ValueError(
-                    f"Sample '{record.sample_id}' has no image and first-frame extraction is disabled."
-                )
 
         metadata = {
             "sample_id": record.sample_id,
@@ -249,30 +373,79 @@ def _prepare_shared_assets(
             "source_image": str(record.image_src) if record.image_src else None,
             "ground_truth_video": str(gt_dst),
             "input_image": str(image_dst) if image_dst else None,
-            "created_utc": datetime.now(timezone.utc).isoformat(),
+            "created_utc": created_utc,
             "row_index": record.row_index,
         }
         metadata_path = sample_root / "sample.json"
         _write_json(metadata_path, metadata)
 
-        assets.append(
-            SampleAssets(
-                sample_id=record.sample_id,
-                prompt_text=record.prompt,
-                prompt_path=prompt_path,
-                gt_video_path=gt_dst,
-                image_path=image_dst,
-                metadata_path=metadata_path,
-            )
+        asset = SampleAssets(
+            sample_id=record.sample_id,
+            prompt_text=record.prompt,
+            prompt_path=prompt_path,
+            gt_video_path=gt_dst,
+            image_path=image_dst,
+            metadata_path=metadata_path,
         )
+        return asset, first_frame_job
+
+    # Samples are independent and syscall-bound; map() keeps manifest order.
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(records)))) as executor:
+        results = list(executor.map(_materialize_one, records))
+
+    assets = [asset for asset, _ in results]
+    first_frame_jobs = [job for _, job in results if job is not None]
+    if first_frame_jobs:
+        _extract_first_frames_batch(first_frame_jobs, ffmpeg_bin)
     return assets
 
 
 def _write_jsonl(path: Path, rows: List[Dict]) -> None:
     _ensure_parent(path)
-    with path.open("w", encoding="utf-8") as handle:
-        for row in rows:
-            handle.write(json.dumps(row, ensure_ascii=False) + "\n")
+    # One buffer, one write per manifest.
+    if orjson is not None:
+        payload = b"".join([orjson.dumps(row) + b"\n" for row in rows])
+    else:
+        payload = "".join([json.dumps(row, ensure_ascii=False) + "\n" for row in rows]).encode("utf-8")
+    path.write_bytes(payload)
+
+
+def _materialize_task_sample(
+    sample: SampleAssets,
+    *,
+    task: str,
+    mode: str,
+    prompt_dir: Path,
+    gt_dir: Path,
+    image_dir: Path,
+    outputs_dir: Path,
+) -> Optional[Dict]:
+    """Place one sample's files for a model/task and return its manifest row (None: i2v without image)."""
+    prompt_dst = prompt_dir / f"{sample.sample_id}.txt"
+    _materialize_file(sample.prompt_path, prompt_dst, mode)
+
+    gt_dst = gt_dir / f"{sample.sample_id}{sample.gt_video_path.suffix}"
+    _materialize_file(sample.gt_video_path, gt_dst, mode)
+
+    output_video = outputs_dir / f"{sample.sample_id}.mp4"
+    row = {
+        "sample_id": sample.sample_id,
+        "task": task,
+        "prompt": sample.prompt_text,
+        "prompt_path": str(prompt_dst),
+        "ground_truth_video": str(gt_dst),
+        "output_video": str(output_video),
+        "metadata_path": str(sample.metadata_path),
+    }
+
+    if task == "i2v":
+        if sample.image_path is None:
+            return None
+        image_dst = image_dir / f"{sample.sample_id}{sample.image_path.suffix}"
+        _materialize_file(sample.image_path, image_dst, mode)
+        row["image_path"] = str(image_dst)
+
+    return row
 
 
 def _build_model_task_layout(
@@ -282,64 +455,55 @@ def _build_model_task_layout(
     dataset_name: str,
     assets: List[SampleAssets],
     mode: str,
+    workers: int,
+    created_utc: str,
 ) -> None:
-    for model in models:
-        for task in tasks:
-            task_root = run_root / model / dataset_name / task
-            inputs_dir = task_root / "inputs"
-            outputs_dir = task_root / "outputs"
-            logs_dir = task_root / "logs"
-            gt_dir = task_root / "ground_truth"
-            prompt_dir = inputs_dir / "prompts"
-            image_dir = inputs_dir / "images"
-
-            for directory in (inputs_dir, outputs_dir, logs_dir, gt_dir, prompt_dir):
-                directory.mkdir(parents=True, exist_ok=True)
-            if task == "i2v":
-                image_dir.mkdir(parents=True, exist_ok=True)
-
-            manifest_rows: List[Dict] = []
-            skipped_i2v: List[str] = []
-            for sample in assets:
-                prompt_dst = prompt_dir / f"{sample.sample_id}.txt"
-                _materialize_file(sample.prompt_path, prompt_dst, mode)
-
-                gt_dst = gt_dir / f"{sample.sample_id}{sample.gt_video_path.suffix}"
-                _materialize_file(sample.gt_video_path, gt_dst, mode)
-
-                output_video = outputs_dir / f"{sample.sample_id}.mp4"
-                row = {
-                    "sample_id": sample.sample_id,
-                    "task": task,
-                    "prompt": sample.prompt_text,
-                    "prompt_path": str(prompt_dst),
-                    "ground_truth_video": str(gt_dst),
-                    "output_video": str(output_video),
-                    "metadata_path": str(sample.metadata_path),
-                }
-
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(assets)))) as executor:
+        for model in models:
+            for task in tasks:
+                task_root = run_root / model / dataset_name / task
+                inputs_dir = task_root / "inputs"
+                outputs_dir = task_root / "outputs"
+                logs_dir = task_root / "logs"
+                gt_dir = task_root / "ground_truth"
+                prompt_dir = inputs_dir / "prompts"
+                image_dir = inputs_dir / "images"
+
+                for directory in (inputs_dir, outputs_dir, logs_dir, gt_dir, prompt_dir):
+                    _ensure_dir(directory)
                 if task == "i2v":
-                    if sample.image_path is None:
-                        skipped_i2v.append(sample.sample_id)
-                        continue
-                    image_dst = image_dir / f"{sample.sample_id}{sample.image_path.suffix}"
-                    _materialize_file(sample.image_path, image_dst, mode)
-                    row["image_path"] = str(image_dst)
+                    _ensure_dir(image_dir)
+
+                materialize = partial(
+                    _materialize_task_sample,
+                    task=task,
+                    mode=mode,
+                    prompt_dir=prompt_dir,
+                    gt_dir=gt_dir,
+                    image_dir=image_dir,
+                    outputs_dir=outputs_dir,
+                )
 
-                manifest_rows.append(row)
+                manifest_rows: List[Dict] = []
+                skipped_i2v: List[str] = []
+                for sample, row in zip(assets, executor.map(materialize, assets)):
+                    if row is None:
+                        skipped_i2v.append(sample.sample_id)
+                    else:
+                        manifest_rows.append(row)
 
-            _write_jsonl(inputs_dir / "manifest.jsonl", manifest_rows)
+                _write_jsonl(inputs_dir / "manifest.jsonl", manifest_rows)
 
-            task_summary = {
-                "model": model,
-                "dataset": dataset_name,
-                "task": task,
-                "num_samples": len(manifest_rows),
-                "skipped_i2v_samples": skipped_i2v,
-                "manifest_path": str(inputs_dir / "manifest.jsonl"),
-                "created_utc": datetime.now(timezone.utc).isoformat(),
-            }
-            _write_json(task_root / "layout_summary.json", task_summary)
+                task_summary = {
+                    "model": model,
+                    "dataset": dataset_name,
+                    "task": task,
+                    "num_samples": len(manifest_rows),
+                    "skipped_i2v_samples": skipped_i2v,
+                    "manifest_path": str(inputs_dir / "manifest.jsonl"),
+                    "created_utc": created_utc,
+                }
+                _write_json(task_root / "layout_summary.json", task_summary)
 
 
 def parse_args() -> argparse.Namespace:
@@ -385,6 +549,18 @@ def parse_args() -> argparse.Namespace:
         action="store_true",
         help="Disable first-frame extraction when image is not present in manifest.",
     )
+    parser.add_argument(
+        "--first-frame-format",
+        choices=("png", "ppm"),
+        default="png",
+        help="Image format for extracted first frames. ppm skips PNG compression but is much larger.",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=32,
+        help="Threads used to materialize per-sample files.",
+    )
     parser.add_argument(
         "--allow-missing-i2v-image",
         action="store_true",
@@ -415,11 +591,12 @@ def main() -> int:
     if unsupported_tasks:
         raise ValueError(f"Unsupported tasks: {unsupported_tasks}. Supported: {DEFAULT_TASKS}")
 
-    rows = _read_manifest(manifest_path)
-    records = _normalize_rows(rows, manifest_dir)
+    records = _normalize_rows(_iter_manifest_rows(manifest_path), manifest_dir)
     if not records:
         raise ValueError("Manifest has no valid rows.")
 
+    # One timestamp for the whole run, shared by sample, task and run summaries.
+    created_utc = datetime.now(timezone.utc).isoformat()
     extract_first_frame = not args.no_extract_first_frame
     strict_i2v_inputs = not args.allow_missing_i2v_image
 
@@ -430,7 +607,10 @@ def main() -> int:
         mode=args.materialize_mode,
         ffmpeg_bin=args.ffmpeg_bin,
         extract_first_frame=extract_first_frame,
+        first_frame_format=args.first_frame_format,
         strict_i2v_inputs=strict_i2v_inputs,
+        workers=args.workers,
+        created_utc=created_utc,
     )
 
     _build_model_task_layout(
@@ -440,6 +620,8 @@ def main() -> int:
         dataset_name=args.dataset_name,
         assets=assets,
         mode=args.materialize_mode,
+        workers=args.workers,
+        created_utc=created_utc,
     )
 
     summary = {
@@ -451,7 +633,8 @@ def main() -> int:
         "num_samples": len(assets),
         "materialize_mode": args.materialize_mode,
         "extract_first_frame": extract_first_frame,
-        "created_utc": datetime.now(timezone.utc).isoformat(),
+        "first_frame_format": args.first_frame_format,
+        "created_utc": created_utc,
     }
     _write_json(run_root / "layout_summary.json", summary)
 
@@ -14,14 +14,54 @@ import html
 import json
 import os
 import re
+import stat
 from dataclasses import dataclass, field
-from functools import partial
+from functools import lru_cache, partial
 from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
 from pathlib import Path
 from typing import Dict, Iterable, List, Optional, Tuple
 
 
 DEFAULT_MODELS = ("wan22", "wan21", "lvp")
+SAFE_NAME_CHARS = "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789._-"
+SAFE_NAME_RE = re.compile(r"[^A-Za-z0-9._-]+")
+# Deletes every allowed character; whatever survives str.translate needs the regex.
+SAFE_NAME_STRIP_TABLE = str.maketrans("", "", SAFE_NAME_CHARS)
+
+HTML_HEAD = "\n".join(
+    (
+        "<!doctype html>",
+        "<html><head><meta charset='utf-8'>",
+        "<meta name='viewport' content='width=device-width, initial-scale=1'>",
+        "<title>Private Inference Gallery</title>",
+        "<style>"
+        "body{font-family:Arial,sans-serif;margin:16px;}"
+        "table{border-collapse:collapse;width:100%;font-size:13px;}"
+        "th,td{border:1px solid #ddd;padding:6px;vertical-align:top;}"
+        "th{position:sticky;top:0;background:#fafafa;z-index:1;}"
+        "video,img{max-width:280px;height:auto;display:block;}"
+        "pre{white-space:pre-wrap;word-break:break-word;margin:0;max-width:420px;}"
+        ".muted{color:#666;font-size:12px;}"
+        "</style>",
+        "</head><body>",
+        "<h2>Private Inference Gallery</h2>",
+        "<div class='muted'>",
+        "Run roots:<br>",
+    )
+)
+PROMPT_CELL_TEMPLATE = "<details><summary>prompt</summary><pre>{}</pre></details>"
+IMAGE_TEMPLATE = "<img src='{}' loading='lazy'>"
+VIDEO_CELL_TEMPLATE = "<td><video controls preload='metadata' src='{}'></video></td>"
+MISSING_CELL = "<td>missing</td>"
+
+# Dataset/task names and media refs repeat across rows; prompts and sample ids
+# are mostly unique and go through html.escape directly.
+_escape_repeated = lru_cache(maxsize=8192)(html.escape)
+
+RANGE_RE = re.compile(r"bytes=(\d*)-(\d*)$")
+
+_LINK_CACHE: Dict[Tuple[Path, Path], Optional[str]] = {}
+_MEDIA_DIR_NAMES: Dict[Path, set[str]] = {}
 
 
 @dataclass
@@ -101,38 +141,76 @@ def _normalize_run_roots(raw_run_roots: Iterable[str]) -> List[Path]:
     return roots
 
 
+def _scan_subdirs(directory: Path) -> List[os.DirEntry]:
+    try:
+        with os.scandir(directory) as it:
+            subdirs = [entry for entry in it if entry.is_dir()]
+    except (FileNotFoundError, NotADirectoryError):
+        return []
+    subdirs.sort(key=lambda entry: entry.name)
+    return subdirs
+
+
 def _discover_manifests(run_root: Path, models: List[str]) -> List[Tuple[str, str, str, Path]]:
+    """List candidate task manifests; callers skip the ones that turn out not to exist."""
     manifests: List[Tuple[str, str, str, Path]] = []
     for model in models:
-        model_root = run_root / model
-        if not model_root.is_dir():
-            continue
-        for dataset_dir in sorted(p for p in model_root.iterdir() if p.is_dir()):
-            for task_dir in sorted(p for p in dataset_dir.iterdir() if p.is_dir()):
-                manifest_path = task_dir / "inputs" / "manifest.jsonl"
-                if manifest_path.is_file():
-                    manifests.append((model, dataset_dir.name, task_dir.name, manifest_path))
+        for dataset_entry in _scan_subdirs(run_root / model):
+            for task_entry in _scan_subdirs(Path(dataset_entry.path)):
+                manifest_path = Path(task_entry.path) / "inputs" / "manifest.jsonl"
+                manifests.append((model, dataset_entry.name, task_entry.name, manifest_path))
     return manifests
 
 
+@lru_cache(maxsize=65536)
 def _safe_media_name(path: Path) -> str:
-    digest = hashlib.sha1(str(path).encode("utf-8")).hexdigest()[:16]
-    stem = re.sub(r"[^A-Za-z0-9._-]+", "_", path.stem)[:80]
+    # 8-byte blake2b gives the same 16 hex chars the name format has always used.
+    digest = hashlib.blake2b(str(path).encode("utf-8"), digest_size=8).hexdigest()
+    stem = path.stem
+    if stem.translate(SAFE_NAME_STRIP_TABLE):
+        stem = SAFE_NAME_RE.sub("_", stem)
+    stem = stem[:80]
     suffix = path.suffix.lower()
     if not suffix:
         suffix = ".bin"
     return f"{digest}_{stem}{suffix}"
 
 
+def _media_names(media_dir: Path) -> set[str]:
+    names = _MEDIA_DIR_NAMES.get(media_dir)
+    if names is None:
+        media_dir.mkdir(parents=True, exist_ok=True)
+        with os.scandir(media_dir) as it:
+            names = {entry.name for entry in it}
+        _MEDIA_DIR_NAMES[media_dir] = names
+    return names
+
+
 def _link_media(src: Optional[Path], media_dir: Path) -> Optional[str]:
     if src is None:
         return None
+    # Ground-truth and image files repeat across tasks; link each source once per run.
+    cache_key = (src, media_dir)
+    if cache_key in _LINK_CACHE:
+        return _LINK_CACHE[cache_key]
+    ref = _link_media_uncached(src, media_dir)
+    _LINK_CACHE[cache_key] = ref
+    return ref
+
+
+def _link_media_uncached(src: Path, media_dir: Path) -> Optional[str]:
     if not src.is_file():
         return None
 
-    media_dir.mkdir(parents=True, exist_ok=True)
+    existing = _media_names(media_dir)
     dst = media_dir / _safe_media_name(src)
     target = Path(os.path.relpath(src, dst.parent))
+    if dst.name not in existing:
+        dst.symlink_to(target)
+        existing.add(dst.name)
+        return f"media/{dst.name}"
+
+    # Left over from an earlier build: keep it only if it still points at src.
     if dst.exists() or dst.is_symlink():
         if dst.is_dir():
             return None
@@ -147,27 +225,60 @@ def _link_media(src: Optional[Path], media_dir: Path) -> Optional[str]:
     return f"media/{dst.name}"
 
 
-def _maybe_pick_existing(current: Optional[Path], candidate: Optional[Path]) -> Optional[Path]:
-    if candidate is None:
-        return current
-    if not candidate.is_file() or candidate.stat().st_size <= 0:
-        return current
-    if current is None:
-        return candidate
+def _scan_outputs(outputs_dir: Path) -> Dict[str, Tuple[Path, float]]:
+    """Map file name -> (path, mtime) for every non-empty regular file in outputs_dir."""
+    found: Dict[str, Tuple[Path, float]] = {}
+    try:
+        with os.scandir(outputs_dir) as it:
+            for entry in it:
+                try:
+                    if not entry.is_file():
+                        continue
+                    st = entry.stat()
+                except OSError:
+                    continue
+                if st.st_size > 0:
+                    found[entry.name] = (Path(entry.path), st.st_mtime)
+    except (FileNotFoundError, NotADirectoryError):
+        pass
+    return found
+
+
+def _stat_output(candidate: Path) -> Optional[Tuple[Path, float]]:
     try:
-        if candidate.stat().st_mtime > current.stat().st_mtime:
-            return candidate
+        st = candidate.stat()
     except OSError:
+        return None
+    if not stat.S_ISREG(st.st_mode) or st.st_size <= 0:
+        return None
+    return candidate, st.st_mtime
+
+
+def _pick_newest(
+    current: Optional[Tuple[Path, float]], candidate: Optional[Tuple[Path, float]]
+) -> Optional[Tuple[Path, float]]:
+    if candidate is None:
         return current
+    if current is None or candidate[1] > current[1]:
+        return candidate
     return current
 
 
 def _collect_entries(run_roots: List[Path], models: List[str]) -> Dict[Tuple[str, str, str], Entry]:
     entries: Dict[Tuple[str, str, str], Entry] = {}
+    newest: Dict[Tuple[Tuple[str, str, str], str], Optional[Tuple[Path, float]]] = {}
 
     for run_root in run_roots:
         for model, dataset, task, manifest_path in _discover_manifests(run_root, models):
-            with manifest_path.open("r", encoding="utf-8") as handle:
+            try:
+                handle = manifest_path.open("r", encoding="utf-8")
+            except (FileNotFoundError, IsADirectoryError, NotADirectoryError):
+                continue
+            # Outputs normally live next to the manifest; list them once instead
+            # of stat-ing every row's output_video.
+            outputs_dir = str(manifest_path.parent.parent / "outputs")
+            outputs = _scan_outputs(Path(outputs_dir))
+            with handle:
                 for line in handle:
                     line = line.strip()
                     if not line:
@@ -195,12 +306,23 @@ def _collect_entries(run_roots: List[Path], models: List[str]) -> Dict[Tuple[str
                         entry.image_path = Path(image)
 
                     output_video = str(row.get("output_video", "")).strip()
-                    candidate = Path(output_video) if output_video else None
-                    entry.outputs[model] = _maybe_pick_existing(entry.outputs.get(model), candidate)
+                    candidate: Optional[Tuple[Path, float]] = None
+                    if output_video:
+                        if os.path.dirname(output_video) == outputs_dir:
+                            candidate = outputs.get(os.path.basename(output_video))
+                        else:
+                            candidate = _stat_output(Path(output_video))
+                    best = _pick_newest(newest.get((key, model)), candidate)
+                    newest[(key, model)] = best
+                    entry.outputs[model] = best[0] if best is not None else None
 
     return entries
 
 
+def _video_cell(ref: Optional[str]) -> str:
+    return VIDEO_CELL_TEMPLATE.format(_escape_repeated(ref)) if ref else MISSING_CELL
+
+
 def _render_html(
     entries: List[Entry],
     models: List[str],
@@ -212,88 +334,136 @@ def _render_html(
     rows_written = 0
     rows_with_any = 0
 
-    parts: List[str] = []
-    parts.append("<!doctype html>")
-    parts.append("<html><head><meta charset='utf-8'>")
-    parts.append("<meta name='viewport' content='width=device-width, initial-scale=1'>")
-    parts.append("<title>Private Inference Gallery</title>")
-    parts.append(
-        "<style>"
-        "body{font-family:Arial,sans-serif;margin:16px;}"
-        "table{border-collapse:collapse;width:100%;font-size:13px;}"
-        "th,td{border:1px solid #ddd;padding:6px;vertical-align:top;}"
-        "th{position:sticky;top:0;background:#fafafa;z-index:1;}"
-        "video,img{max-width:280px;height:auto;display:block;}"
-        "pre{white-space:pre-wrap;word-break:break-word;margin:0;max-width:420px;}"
-        ".muted{color:#666;font-size:12px;}"
-        "</style>"
-    )
-    parts.append("</head><body>")
-    parts.append("<h2>Private Inference Gallery</h2>")
-    parts.append("<div class='muted'>")
-    parts.append("Run roots:<br>")
-    for root in run_roots:
-        parts.append(f"{html.escape(str(root))}<br>")
-    parts.append("</div><br>")
-    parts.append("<table>")
-    parts.append(
+    index_path = output_dir / "index.html"
+    tmp_path = output_dir / "index.html.tmp"
+    output_dir.mkdir(parents=True, exist_ok=True)
+    header_row = (
         "<tr><th>dataset/task/sample</th><th>prompt + i2v image</th><th>ground truth</th>"
         + "".join(f"<th>{html.escape(m)}</th>" for m in models)
         + "</tr>"
     )
+    # The row layout is fixed once the model list is known: build one template
+    # with a positional slot per cell and fill it with a single format() per row.
+    row_template = (
+        "<tr>\n<td><b>{0}</b>/<b>{1}</b><br>{2}</td>\n<td>{3}</td>\n{4}\n"
+        + "".join(f"{{{5 + i}}}\n" for i in range(len(models)))
+        + "</tr>\n"
+    )
 
-    for entry in entries:
-        has_any = any(p is not None and p.is_file() for p in entry.outputs.values())
-        if has_any:
-            rows_with_any += 1
-        if (not include_missing) and (not has_any):
-            continue
-
-        prompt = html.escape(entry.prompt)
-        img_ref = _link_media(entry.image_path, media_dir)
-        gt_ref = _link_media(entry.ground_truth_video, media_dir)
-
-        parts.append("<tr>")
-        parts.append(
-            f"<td><b>{html.escape(entry.dataset)}</b>/<b>{html.escape(entry.task)}</b>"
-            f"<br>{html.escape(entry.sample_id)}</td>"
-        )
-        prompt_cell = "<details><summary>prompt</summary><pre>{}</pre></details>".format(prompt)
-        if img_ref:
-            prompt_cell += f"<img src='{html.escape(img_ref)}' loading='lazy'>"
-        parts.append(f"<td>{prompt_cell}</td>")
-
-        if gt_ref:
-            parts.append(
-                "<td><video controls preload='metadata' src='{}'></video></td>".format(
-                    html.escape(gt_ref)
+    # Fragments are newline-separated and streamed straight to disk, then swapped
+    # into place so a browser never sees a half-written page.
+    with tmp_path.open("w", encoding="utf-8", buffering=1 << 20) as handle:
+        write = handle.write
+        write(HTML_HEAD)
+        write("\n")
+        for root in run_roots:
+            write(f"{html.escape(str(root))}<br>\n")
+        write("</div><br>\n<table>\n")
+        write(header_row)
+        write("\n")
+
+        for entry in entries:
+            has_any = any(p is not None and p.is_file() for p in entry.outputs.values())
+            if has_any:
+                rows_with_any += 1
+            if (not include_missing) and (not has_any):
+                continue
+
+            prompt = html.escape(entry.prompt)
+            img_ref = _link_media(entry.image_path, media_dir)
+            gt_ref = _link_media(entry.ground_truth_video, media_dir)
+
+            prompt_cell = PROMPT_CELL_TEMPLATE.format(prompt)
+            if img_ref:
+                prompt_cell += IMAGE_TEMPLATE.format(_escape_repeated(img_ref))
+            model_cells = [_video_cell(_link_media(entry.outputs.get(model), media_dir)) for model in models]
+            write(
+                row_template.format(
+                    _escape_repeated(entry.dataset),
+                    _escape_repeated(entry.task),
+                    html.escape(entry.sample_id),
+                    prompt_cell,
+                    _video_cell(gt_ref),
+                    *model_cells,
                 )
             )
-        else:
-            parts.append("<td>missing</td>")
+            rows_written += 1
 
-        for model in models:
-            ref = _link_media(entry.outputs.get(model), media_dir)
-            if ref:
-                cell = "<video controls preload='metadata' src='{}'></video>".format(html.escape(ref))
-            else:
-                cell = "missing"
-            parts.append(f"<td>{cell}</td>")
-        parts.append("</tr>")
-        rows_written += 1
-
-    parts.append("</table>")
-    parts.append(
-        f"<p class='muted'>Rendered rows: {rows_written} | Rows with any model output: {rows_with_any}</p>"
-    )
-    parts.append("</body></html>")
-
-    index_path = output_dir / "index.html"
-    output_dir.mkdir(parents=True, exist_ok=True)
-    index_path.write_text("\n".join(parts), encoding="utf-8")
+        write("</table>\n")
+        write(
+            f"<p class='muted'>Rendered rows: {rows_written} | Rows with any model output: {rows_with_any}</p>\n"
+        )
+        write("</body></html>")
+    os.replace(tmp_path, index_path)
     return rows_written, rows_with_any
 
 
+class RangeRequestHandler(SimpleHTTPRequestHandler):
+    """Static handler that answers single-range requests and sends bodies with sendfile.
+
+    Browsers fetch <video> sources as Range requests; SimpleHTTPRequestHandler
+    ignores Range and streams the whole file through a Python read/write loop.
+    """
+
+    _range: Optional[Tuple[int, int]] = None
+
+    def end_headers(self) -> None:
+        self.send_header("Accept-Ranges", "bytes")
+        super().end_headers()
+
+    def send_head(self):
+        self._range = None
+        match = RANGE_RE.match(self.headers.get("Range", "").strip())
+        path = self.translate_path(self.path)
+        # Directories and trailing-slash paths keep the base class's redirect/404.
+        if match is None or match.group(0) == "bytes=-" or path.endswith("/") or os.path.isdir(path):
+            return super().send_head()
+        first, last = match.groups()
+        if first and last and int(last) < int(first):
+            # A syntactically invalid range is ignored and the full body served (RFC 7233).
+            return super().send_head()
+
+        try:
+            f = open(path, "rb")
+        except OSError:
+            self.send_error(404, "File not found")
+            return None
+        try:
+            fs = os.fstat(f.fileno())
+            size = fs.st_size
+            if first:
+                start = int(first)
+                end = min(int(last), size - 1) if last else size - 1
+            else:
+                start = max(0, size - int(last))
+                end = size - 1
+            # Only a start past the end (or an empty suffix) is unsatisfiable.
+            if start > end:
+                f.close()
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{size}")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return None
+
+            self.send_response(206)
+            self.send_header("Content-Type", self.guess_type(path))
+            self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+            self.send_header("Content-Length", str(end - start + 1))
+            self.send_header("Last-Modified", self.date_time_string(fs.st_mtime))
+            self.end_headers()
+            self._range = (start, end - start + 1)
+            return f
+        except Exception:
+            f.close()
+            raise
+
+    def copyfile(self, source, outputfile) -> None:
+        offset, count = self._range if self._range is not None else (0, None)
+        # socket.sendfile uses os.sendfile and falls back to send() where unsupported.
+        self.connection.sendfile(source, offset, count)
+
+
 def main() -> int:
     args = parse_args()
     models = [m.strip() for m in args.models.split(",") if m.strip()]
@@ -333,7 +503,7 @@ def main() -> int:
         f"  ssh -N -L {args.port}:127.0.0.1:{args.port} $USER@login.rc.fas.harvard.edu"
     )
 
-    handler = partial(SimpleHTTPRequestHandler, directory=str(output_dir))
+    handler = partial(RangeRequestHandler, directory=str(output_dir))
     server = ThreadingHTTPServer((args.bind, args.port), handler)
     try:
         server.serve_forever()
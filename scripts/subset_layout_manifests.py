@@ -12,10 +12,19 @@ from __future__ import annotations
 
 import argparse
 import json
+import mmap
+import os
 import re
-from dataclasses import dataclass
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from pathlib import Path
-from typing import Dict, Iterable, List, Optional, Sequence, Set, Tuple
+from typing import Any, BinaryIO, Dict, FrozenSet, Iterable, Iterator, List, Optional, Sequence, Set, Tuple, Union
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 
 DEFAULT_MODELS = ("wan22", "wan21", "lvp")
@@ -23,13 +32,14 @@ DEFAULT_TASKS = ("t2v", "i2v")
 PERSPECTIVES = ("left", "center", "right")
 
 PERSPECTIVE_RE = re.compile(r"_perspective-(left|center|right)_")
-LEADING_INDEX_RE = re.compile(r"^\d+_")
-
-
-@dataclass
-class Row:
-    sample_id: str
-    payload: Dict
+# Kept lines are handed to writelines() in batches of this many.
+WRITE_BATCH_LINES = 4096
+# Plain (escape-free) string sample_id values; anything else falls back to json.loads.
+SAMPLE_ID_RE = re.compile(rb'"sample_id"\s*:\s*"([^"\\]*)"')
+# Literal patterns used to tally lines and keys over an mmap in _scan_sample_ids.
+NEWLINE_RE = re.compile(rb"\n")
+LEADING_SAMPLE_ID_RE = re.compile(rb'\n\{"sample_id"')
+SAMPLE_ID_TOKEN_RE = re.compile(rb'"sample_id"')
 
 
 def parse_args() -> argparse.Namespace:
@@ -81,6 +91,11 @@ def parse_args() -> argparse.Namespace:
         action="store_true",
         help="Print selection and counts without writing manifests.",
     )
+    parser.add_argument(
+        "--force-rewrite",
+        action="store_true",
+        help="Rewrite (and back up) manifests even when no rows would be dropped.",
+    )
     return parser.parse_args()
 
 
@@ -88,86 +103,223 @@ def _split_csv(raw: str) -> List[str]:
     return [x.strip() for x in raw.split(",") if x.strip()]
 
 
-def _read_jsonl(path: Path) -> List[Row]:
-    rows: List[Row] = []
-    with path.open("r", encoding="utf-8") as handle:
-        for line in handle:
-            line = line.strip()
+def _loads(line: bytes) -> Any:
+    if orjson is not None:
+        return orjson.loads(line)
+    return json.loads(line)
+
+
+def _line_sample_id(line: bytes) -> str:
+    # Trust the regex only for a lone sample_id token that is a key of the
+    # top-level object: nothing but the opening brace may nest it, and no
+    # escape may put it inside another string. Anything else goes to _loads.
+    if line.count(b'"sample_id"') == 1:
+        match = SAMPLE_ID_RE.search(line)
+        if match is not None:
+            prefix = line[: match.start()]
+            if prefix.count(b"{") == 1 and b"[" not in prefix and b"\\" not in prefix:
+                return match.group(1).decode("utf-8").strip()
+    return str(_loads(line).get("sample_id", "")).strip()
+
+
+def _iter_jsonl(path: Path) -> Iterator[Tuple[str, bytes]]:
+    """Yield (sample_id, raw_line) pairs; raw_line always ends with a newline."""
+    with path.open("rb") as handle:
+        for raw in handle:
+            line = raw.strip()
             if not line:
                 continue
-            payload = json.loads(line)
-            sample_id = str(payload.get("sample_id", "")).strip()
+            sample_id = _line_sample_id(line)
             if not sample_id:
                 continue
-            rows.append(Row(sample_id=sample_id, payload=payload))
-    return rows
-
-
-def _write_jsonl(path: Path, rows: Iterable[Row]) -> None:
-    with path.open("w", encoding="utf-8") as handle:
-        for row in rows:
-            handle.write(json.dumps(row.payload, ensure_ascii=False) + "\n")
+            yield sample_id, raw if raw.endswith(b"\n") else raw + b"\n"
+
+
+@contextmanager
+def _mapped(path: Path) -> Iterator[Union[bytes, mmap.mmap]]:
+    """Map ``path`` read-only; empty files (which cannot be mapped) yield b""."""
+    with path.open("rb") as handle:
+        if os.fstat(handle.fileno()).st_size == 0:
+            yield b""
+            return
+        with mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            yield mm
+
+
+def _iter_sample_ids(data: Union[bytes, mmap.mmap]) -> Iterator[str]:
+    """Yield reference sample_ids, slicing lines straight out of the mapped file."""
+    size = len(data)
+    start = 0
+    while start < size:
+        nl = data.find(b"\n", start)
+        end = size if nl < 0 else nl
+        line = data[start:end].strip()
+        start = end + 1
+        if not line:
+            continue
+        sample_id = _line_sample_id(line)
+        if sample_id:
+            yield sample_id
+
+
+def _scan_sample_ids(data: Union[bytes, mmap.mmap]) -> Optional[List[str]]:
+    """Extract every sample_id with one findall() over the mapped file.
+
+    Only used when every line opens with a plain ``{"sample_id": "..."`` and
+    holds no other sample_id key, which is how layout manifests are written;
+    returns None otherwise so callers fall back to _iter_sample_ids.
+    """
+    if not data:
+        return []
+    # mmap has no count(), so the line/token tallies are regex scans too.
+    lines = len(NEWLINE_RE.findall(data)) + (data[-1:] != b"\n")
+    leading = len(LEADING_SAMPLE_ID_RE.findall(data)) + (data[:12] == b'{"sample_id"')
+    if leading != lines or len(SAMPLE_ID_TOKEN_RE.findall(data)) != lines:
+        return None
+    raw_ids = SAMPLE_ID_RE.findall(data)
+    if len(raw_ids) != lines:
+        return None
+    return [sample_id for sample_id in (raw.decode("utf-8").strip() for raw in raw_ids) if sample_id]
+
+
+def _filter_jsonl(path: Path, selected: FrozenSet[str], out: Optional[BinaryIO] = None) -> Tuple[int, int]:
+    """Return (rows with a sample_id, selected rows), streaming selected lines to ``out``.
+
+    Only the sample_id is extracted per line and kept lines are written
+    verbatim, so rejected rows are never fully parsed or re-serialized.
+    """
+    total = 0
+    kept = 0
+    batch: List[bytes] = []
+    for sample_id, line in _iter_jsonl(path):
+        total += 1
+        if sample_id in selected:
+            kept += 1
+            if out is not None:
+                batch.append(line)
+                if len(batch) >= WRITE_BATCH_LINES:
+                    out.writelines(batch)
+                    batch.clear()
+    if batch:
+        out.writelines(batch)
+    return total, kept
 
 
 def _sample_group(sample_id: str) -> Tuple[str, Optional[str]]:
-    normalized = LEADING_INDEX_RE.sub("", sample_id)
+    # A leading "<digits>_" index is dropped and every "_perspective-<p>_" marker
+    # collapses to "_". One regex scan: the index is stripped with str ops and the
+    # group key is sliced around the match.
+    index, sep, rest = sample_id.partition("_")
+    normalized = rest if sep and index.isdecimal() else sample_id
     match = PERSPECTIVE_RE.search(normalized)
     if not match:
         return normalized, None
-    perspective = match.group(1)
-    group_key = PERSPECTIVE_RE.sub("_", normalized)
-    return group_key, perspective
+    tail = normalized[match.end() :]
+    if "_perspective-" in tail:
+        tail = PERSPECTIVE_RE.sub("_", tail)
+    return normalized[: match.start()] + "_" + tail, match.group(1)
 
 
 def _select_ids(
-    ordered_ids: Sequence[str],
+    ordered_ids: Iterable[str],
     max_per_dataset: int,
     preference: Sequence[str],
 ) -> List[str]:
-    grouped: Dict[str, Dict[str, str]] = {}
-    group_order: List[str] = []
+    # Rank every perspective once: singletons win (-1), then the preference
+    # order, then the remaining perspectives alphabetically. Only the best
+    # (rank, sample_id) per group is kept; ties go to the later row.
+    rank: Dict[Optional[str], int] = {None: -1}
+    # setdefault: a perspective listed twice keeps its first (best) position.
+    for i, p in enumerate(preference):
+        rank.setdefault(p, i)
+    for p in sorted(PERSPECTIVES):
+        rank.setdefault(p, len(rank) + len(preference))
+    best: Dict[str, Tuple[int, str]] = {}
 
     for sid in ordered_ids:
         gkey, perspective = _sample_group(sid)
-        if gkey not in grouped:
-            grouped[gkey] = {}
-            group_order.append(gkey)
-        if perspective is None:
-            # singleton/non-triplet sample
-            grouped[gkey]["__single__"] = sid
-        else:
-            grouped[gkey][perspective] = sid
-
-    selected: List[str] = []
-    for gkey in group_order:
-        bucket = grouped[gkey]
-        chosen: Optional[str] = None
-
-        # singleton/non-triplet fallback
-        if "__single__" in bucket:
-            chosen = bucket["__single__"]
-        else:
-            for p in preference:
-                if p in bucket:
-                    chosen = bucket[p]
-                    break
-            if chosen is None and bucket:
-                # deterministic fallback
-                chosen = bucket[sorted(bucket.keys())[0]]
-
-        if chosen is None:
+        r = rank[perspective]
+        cur = best.get(gkey)
+        if cur is not None and r > cur[0]:
             continue
-        selected.append(chosen)
-        if max_per_dataset > 0 and len(selected) >= max_per_dataset:
-            break
+        best[gkey] = (r, sid)
 
+    selected = [sid for _, sid in best.values()]
+    if max_per_dataset > 0:
+        del selected[max_per_dataset:]
     return selected
 
 
+def _ends_with_newline(path: Path) -> bool:
+    with path.open("rb") as handle:
+        handle.seek(-1, os.SEEK_END)
+        return handle.read(1) == b"\n"
+
+
+def _copy_atomic(src: Path, dst: Path) -> None:
+    # A half-copied backup would be trusted by every later run, so it only
+    # appears under its final name once complete.
+    tmp_path = dst.with_name(dst.name + ".tmp")
+    try:
+        shutil.copyfile(src, tmp_path)
+        os.replace(tmp_path, dst)
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
+
+
+def _process_manifest(
+    manifest_path: Path,
+    selected: FrozenSet[str],
+    backup_suffix: str,
+    dry_run: bool,
+    force_rewrite: bool = False,
+) -> Tuple[int, int, Optional[Path]]:
+    """Filter one existing manifest down to ``selected``.
+
+    Returns (total, kept, backup_path); backup_path is None when the filtered
+    output would be byte-identical and the manifest was left untouched.
+    """
+    backup_path = manifest_path.with_name(manifest_path.name + backup_suffix)
+    if dry_run:
+        total, kept = _filter_jsonl(manifest_path, selected)
+        return total, kept, backup_path
+
+    # Stream survivors into a sibling temp file and swap it in, so an
+    # interrupted run never leaves a truncated manifest behind.
+    size = manifest_path.stat().st_size
+    tmp_path = manifest_path.with_name(manifest_path.name + ".tmp")
+    try:
+        with tmp_path.open("wb", buffering=1 << 20) as handle:
+            total, kept = _filter_jsonl(manifest_path, selected, handle)
+            written = handle.tell()
+        unchanged = kept == total and written == size and (size == 0 or _ends_with_newline(manifest_path))
+        if unchanged and not force_rewrite:
+            # Nothing was dropped; keep the original (and its mtime) as is.
+            tmp_path.unlink()
+            return total, kept, None
+        if not backup_path.exists():
+            _copy_atomic(manifest_path, backup_path)
+        os.replace(tmp_path, manifest_path)
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
+    return total, kept, backup_path
+
+
 def _manifest_path(run_root: Path, model: str, dataset: str, task: str) -> Path:
     return run_root / model / dataset / task / "inputs" / "manifest.jsonl"
 
 
+def _existing_manifests(run_root: Path, dataset: str) -> Set[Tuple[str, str]]:
+    """Return the (model, task) pairs that have a manifest for ``dataset``, from one glob."""
+    existing: Set[Tuple[str, str]] = set()
+    for path in run_root.glob(f"*/{dataset}/*/inputs/manifest.jsonl"):
+        if path.is_file():
+            existing.add((path.parts[-5], path.parts[-3]))
+    return existing
+
+
 def main() -> int:
     args = parse_args()
 
@@ -187,20 +339,24 @@ def main() -> int:
         raise ValueError("datasets/models/tasks must be non-empty.")
 
     for dataset in datasets:
+        existing = _existing_manifests(run_root, dataset)
         ref_manifest = _manifest_path(run_root, args.reference_model, dataset, args.reference_task)
-        if not ref_manifest.is_file():
+        if (args.reference_model, args.reference_task) not in existing:
             raise FileNotFoundError(
                 f"Reference manifest not found for dataset '{dataset}': {ref_manifest}"
             )
 
-        ref_rows = _read_jsonl(ref_manifest)
-        ordered_ids = [r.sample_id for r in ref_rows]
-        selected_ids = _select_ids(
-            ordered_ids=ordered_ids,
-            max_per_dataset=args.max_per_dataset,
-            preference=preference,
-        )
-        selected_set: Set[str] = set(selected_ids)
+        # Every reference row can still change a group's pick, so the whole
+        # file is read through one mapping: the one-shot scan first, and the
+        # per-line reader only when the scan bails.
+        with _mapped(ref_manifest) as data:
+            scanned = _scan_sample_ids(data)
+            selected_ids = _select_ids(
+                ordered_ids=_iter_sample_ids(data) if scanned is None else scanned,
+                max_per_dataset=args.max_per_dataset,
+                preference=preference,
+            )
+        selected_set: FrozenSet[str] = frozenset(selected_ids)
 
         print(
             f"[{dataset}] selected {len(selected_ids)} sample_ids "
@@ -209,30 +365,38 @@ def main() -> int:
         if selected_ids:
             print(f"[{dataset}] first 5 selected: {selected_ids[:5]}")
 
-        for model in models:
-            for task in tasks:
-                manifest_path = _manifest_path(run_root, model, dataset, task)
-                if not manifest_path.is_file():
-                    print(f"skip missing manifest: {manifest_path}")
-                    continue
+        # Manifests are independent files, so filter all (model, task) pairs
+        # concurrently; map() keeps the report in the usual order. Repeated
+        # --models/--tasks entries are collapsed so no file has two writers.
+        jobs = list(
+            dict.fromkeys(
+                (model, task, _manifest_path(run_root, model, dataset, task))
+                for model in models
+                for task in tasks
+            )
+        )
 
-                rows = _read_jsonl(manifest_path)
-                out_rows = [r for r in rows if r.sample_id in selected_set]
+        def _run(job: Tuple[str, str, Path]) -> Optional[Tuple[int, int, Path]]:
+            if (job[0], job[1]) not in existing:
+                return None
+            return _process_manifest(
+                job[2], selected_set, args.backup_suffix, args.dry_run, args.force_rewrite
+            )
 
-                backup_path = manifest_path.with_name(manifest_path.name + args.backup_suffix)
+        with ThreadPoolExecutor(max_workers=len(jobs)) as executor:
+            results = executor.map(_run, jobs)
+            for (model, task, manifest_path), result in zip(jobs, results):
+                if result is None:
+                    print(f"skip missing manifest: {manifest_path}")
+                    continue
+                total, kept, backup_path = result
+                if backup_path is None:
+                    print(f"  [{model}/{dataset}/{task}] {total} -> {kept} rows (unchanged, skipping write)")
+                    continue
                 print(
-                    f"  [{model}/{dataset}/{task}] {len(rows)} -> {len(out_rows)} rows "
+                    f"  [{model}/{dataset}/{task}] {total} -> {kept} rows "
                     f"(backup: {backup_path.name})"
                 )
-                if args.dry_run:
-                    continue
-
-                if not backup_path.exists():
-                    backup_path.write_text(
-                        "".join(json.dumps(r.payload, ensure_ascii=False) + "\n" for r in rows),
-                        encoding="utf-8",
-                    )
-                _write_jsonl(manifest_path, out_rows)
 
     if args.dry_run:
         print("Dry-run complete; no files were written.")